@@ -5,6 +5,7 @@ Spacetime OIDC login (Authorization Code + PKCE only).
 Minimal inputs via environment variables (e.g., .env.oidc):
     - OIDC_CLIENT_ID  (required)
     - OIDC_TIMEOUT    (seconds, optional, default: 180)
+    - OIDC_NO_CACHE   (optional, set to 1 to disable the token cache)
 
 Fixed constants (not overridable):
     - AUTH URL:    http://127.0.0.1:8000/o/authorize/
@@ -12,8 +13,16 @@ Fixed constants (not overridable):
     - SCOPE:       "openid profile email offline_access"
     - REDIRECT URI: http://127.0.0.1:8765/callback
 
+The endpoints are used as-is; no OIDC discovery request
+(/.well-known/openid-configuration) is made.
+
+An id_token that `spacetime login` accepted is cached in
+$XDG_STATE_HOME/spacetime-oidc/ (default: ~/.local/state) and reused while
+valid, skipping steps 1-3. If the CLI rejects the cached token, the cache
+file is removed and the normal flow runs.
+
 Flow:
-    1) Start local HTTP server and wait for callback.
+    1) Listen on the redirect port and wait for the callback.
     2) Open browser to the authorization URL (PKCE).
     3) Exchange code for tokens.
     4) Run `spacetime login --token <id|access>`.
@@ -24,83 +33,84 @@ from __future__ import annotations
 
 import base64
 import hashlib
-import http.server
 import json
 import os
+import re
 import socket
-import socketserver
 import subprocess
 import sys
-import threading
 import time
 import urllib.parse
-import urllib.request
-import webbrowser
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Optional
 
 # Fixed constants (not read from env)
 AUTH_URL = "http://127.0.0.1:8000/o/authorize/"
-TOKEN_URL = "http://127.0.0.1:8000/o/token/"
+TOKEN_HOST, TOKEN_PORT, TOKEN_PATH = "127.0.0.1", 8000, "/o/token/"
 SCOPE = "openid"
-REDIRECT_URI = "http://127.0.0.1:8765/callback"
+REDIRECT_HOST, REDIRECT_PORT, REDIRECT_PATH = "127.0.0.1", 8765, "/callback"
+REDIRECT_URI = f"http://{REDIRECT_HOST}:{REDIRECT_PORT}{REDIRECT_PATH}"
 
+# Token fields of a flat token endpoint response whose value has no escapes
+_TOK_RE = re.compile(r'[{,]\s*"(id_token|access_token)"\s*:\s*"([^"\\]+)"\s*(?=[,}])')
 
-def env(name: str, default: Optional[str] = None) -> str:
-    val = os.environ.get(name)
-    if val is None:
-        return "" if default is None else default
-    return val
+# Query parameters of the authorization URL that do not change per run
+_AUTH_STATIC = urllib.parse.urlencode(
+    {
+        "response_type": "code",
+        "redirect_uri": REDIRECT_URI,
+        "scope": SCOPE,
+        "code_challenge_method": "S256",
+    },
+    quote_via=urllib.parse.quote,
+)
 
 
 def b64url_no_pad(data: bytes) -> str:
-    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
 
 
 def make_pkce_pair() -> tuple[str, str]:
     # RFC 7636: code_verifier length 43-128 chars; use a urlsafe random string
     # Use 64 bytes entropy -> ~86 chars after base64url (within limits)
-    verifier = b64url_no_pad(os.urandom(64))
-    challenge = b64url_no_pad(hashlib.sha256(verifier.encode()).digest())
+    raw = base64.urlsafe_b64encode(os.urandom(64)).rstrip(b"=")
+    verifier = raw.decode("ascii")
+    # raw is the ASCII form of the verifier, i.e. what S256 must hash
+    challenge = base64.urlsafe_b64encode(hashlib.sha256(raw).digest()).rstrip(b"=").decode("ascii")
     return verifier, challenge
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Config:
     client_id: str
-    auth_url: str
-    token_url: str
-    scope: str
-    redirect_uri: str
     timeout: int
+    use_cache: bool
 
     @staticmethod
     def from_env() -> "Config":
-        client_id_val = env("OIDC_CLIENT_ID")
-        if not client_id_val:
-            print(
-                "Missing OIDC_CLIENT_ID environment variable.",
-                file=sys.stderr,
-            )
-            sys.exit(2)
-        # Use sane constants, do not read these from env
-        auth_url_val = AUTH_URL
-        token_url_val = TOKEN_URL
-        scope_val = SCOPE
-        redirect_uri_val = REDIRECT_URI
-        timeout_str = env("OIDC_TIMEOUT", "180") or "180"
-        try:
-            timeout_val = int(timeout_str)
-        except ValueError:
-            timeout_val = 180
-        return Config(
-            client_id=client_id_val,
-            auth_url=auth_url_val,
-            token_url=token_url_val,
-            scope=scope_val,
-            redirect_uri=redirect_uri_val,
-            timeout=timeout_val,
+        return _config_from_env()
+
+
+@lru_cache(maxsize=1)
+def _config_from_env() -> Config:
+    client_id_val = os.environ.get("OIDC_CLIENT_ID") or ""
+    if not client_id_val:
+        print(
+            "Missing OIDC_CLIENT_ID environment variable.",
+            file=sys.stderr,
         )
+        sys.exit(2)
+    try:
+        timeout_val = int(os.environ.get("OIDC_TIMEOUT") or "180")
+    except ValueError:
+        timeout_val = 180
+    # Endpoints, scope and redirect URI are module constants, not env
+    return Config(
+        client_id=client_id_val,
+        timeout=timeout_val,
+        use_cache=(os.environ.get("OIDC_NO_CACHE") or "0") == "0",
+    )
 
 
 class CodeReceiver:
@@ -111,123 +121,241 @@ class CodeReceiver:
         self.state = state
         self.code: Optional[str] = None
         self.recv_state: Optional[str] = None
-        self._server: Optional[socketserver.TCPServer] = None
-        self._thread: Optional[threading.Thread] = None
+        self.error: Optional[str] = None
+        self.error_description: Optional[str] = None
+        self.timed_out = False
+        self._sock: Optional[socket.socket] = None
 
     def start(self) -> None:
-        receiver = self
-
-        class Handler(http.server.BaseHTTPRequestHandler):
-            def do_GET(self):  # type: ignore[override]
-                parsed = urllib.parse.urlparse(self.path)
-                if parsed.path != receiver.path:
-                    self.send_response(404)
-                    self.end_headers()
-                    self.wfile.write(b"Not Found")
-                    return
-                q = urllib.parse.parse_qs(parsed.query)
-                receiver.code = (q.get("code") or [""])[0]
-                receiver.recv_state = (q.get("state") or [""])[0]
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"Login complete. You can close this tab.")
-                # Shutdown server in a separate thread to avoid deadlock
-                threading.Thread(
-                    target=self.server.shutdown,
-                    daemon=True,
-                ).start()
-
-            def log_message(self, format, *args):
-                return  # silence
-
-        # Ensure port is free (quick check)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            try:
-                s.bind((self.host, self.port))
-            except OSError as e:
-                msg = f"Cannot bind callback server on " f"{self.host}:{self.port}: {e}"
-                print(msg, file=sys.stderr)
-                sys.exit(2)
-        # Start server
-        self._server = socketserver.TCPServer((self.host, self.port), Handler)
-        self._thread = threading.Thread(
-            target=self._server.serve_forever,
-            daemon=True,
-        )
-        self._thread.start()
+        # create_server sets SO_REUSEADDR and closes the socket if bind fails
+        try:
+            self._sock = socket.create_server((self.host, self.port), backlog=1)
+        except OSError as e:
+            msg = f"Cannot bind callback server on " f"{self.host}:{self.port}: {e}"
+            print(msg, file=sys.stderr)
+            sys.exit(2)
 
     def wait_for_code(self, timeout: int) -> tuple[Optional[str], Optional[str]]:
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            if self.code and self.recv_state:
-                break
-            time.sleep(0.25)
-        self.stop()
+        # Serve connections on this thread until the callback arrives.
+        # Stray requests (favicon, idle preconnects) are answered and skipped.
+        deadline = time.monotonic() + timeout
+        try:
+            while self._sock is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timed_out = True
+                    break
+                self._sock.settimeout(remaining)
+                try:
+                    conn, _ = self._sock.accept()
+                except socket.timeout:
+                    self.timed_out = True
+                    break
+                with conn:
+                    if self._handle(conn, min(remaining, 5.0)):
+                        break
+        finally:
+            self.stop()
         return self.code, self.recv_state
 
+    def _handle(self, conn: socket.socket, timeout: float) -> bool:
+        conn.settimeout(timeout)
+        # Only the request line is needed; headers and body are ignored.
+        data = b""
+        try:
+            while b"\r\n" not in data and len(data) < 8192:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        except OSError:
+            return False
+        parts = data.split(b"\r\n", 1)[0].split(b" ")
+        if len(parts) != 3 or parts[0] != b"GET":
+            return False
+        path, _, query = parts[1].partition(b"?")
+        if path != self.path.encode():
+            self._respond(conn, b"404 Not Found", b"Not Found")
+            return False
+        q = urllib.parse.parse_qs(query.decode("latin-1"))
+        self.code = (q.get("code") or [""])[0]
+        self.recv_state = (q.get("state") or [""])[0]
+        # Authorization errors are redirected here too (RFC 6749, 4.1.2.1)
+        self.error = (q.get("error") or [None])[0]
+        self.error_description = (q.get("error_description") or [None])[0]
+        if self.error:
+            self._respond(conn, b"200 OK", b"Login failed. You can close this tab.")
+        else:
+            self._respond(conn, b"200 OK", b"Login complete. You can close this tab.")
+        return True
+
+    @staticmethod
+    def _respond(conn: socket.socket, status: bytes, body: bytes) -> None:
+        try:
+            conn.sendall(
+                b"HTTP/1.0 " + status + b"\r\n"
+                b"Content-Type: text/plain; charset=utf-8\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+        except OSError:
+            pass
+
     def stop(self) -> None:
-        if self._server:
-            try:
-                self._server.shutdown()
-                self._server.server_close()
-            except Exception:
-                pass
-            self._server = None
-        if self._thread and self._thread.is_alive():
-            try:
-                self._thread.join(timeout=1.0)
-            except Exception:
-                pass
-            self._thread = None
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+
+def _token_fields(body: str) -> dict:
+    # Tokens are plain base64url strings, so a regex scan usually finds them.
+    # Nested objects, escaped values and error responses go through json.
+    tok = dict(_TOK_RE.findall(body))
+    if body.count("{") != 1 or any(f'"{k}"' in body and k not in tok for k in ("id_token", "access_token")):
+        tok = json.loads(body)
+        if not isinstance(tok, dict):
+            raise ValueError("token response is not a JSON object")
+    return tok
+
+
+def _token_cache_path(client_id: str) -> str:
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    name = f"token-{urllib.parse.quote(client_id, safe='')}.json"
+    return os.path.join(state_home, "spacetime-oidc", name)
+
+
+def _token_exp(token: str) -> Optional[int]:
+    # exp claim of a JWT; None for opaque tokens or unparseable payloads
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return int(claims["exp"])
+    except Exception:
+        return None
+
+
+def _load_cached_token(client_id: str) -> Optional[str]:
+    try:
+        with open(_token_cache_path(client_id), encoding="utf-8") as f:
+            token = json.load(f)["token"]
+    except Exception:
+        return None
+    exp = _token_exp(token)
+    if exp is None or exp - time.time() <= 30:
+        return None
+    return token
+
+
+def _store_token(client_id: str, token: str) -> None:
+    if _token_exp(token) is None:
+        return
+    import tempfile
+
+    path = _token_cache_path(client_id)
+    cache_dir = os.path.dirname(path)
+    tmp = None
+    try:
+        # makedirs' mode does not apply to an existing directory
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        os.chmod(cache_dir, 0o700)
+        # mkstemp creates the file with mode 0600; os.replace swaps it in
+        # atomically instead of reusing an existing file and its mode
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=".token-", suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"token": token}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        if tmp is not None:
+            _remove_quietly(tmp)
+        print(f"Could not cache token in {path}: {e}", file=sys.stderr)
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _drop_cached_token(client_id: str) -> None:
+    _remove_quietly(_token_cache_path(client_id))
+
+
+def spacetime_login(token: str) -> Optional[int]:
+    # Exit status of `spacetime login`; None if the CLI is missing
+    try:
+        r = subprocess.run(
+            ["spacetime", "login", "--token", token],
+            check=False,
+        )
+    except FileNotFoundError:
+        print("'spacetime' CLI not found in PATH.", file=sys.stderr)
+        return None
+    return r.returncode
 
 
 def main() -> int:
     cfg = Config.from_env()
 
-    # Parse redirect target
-    ru = urllib.parse.urlparse(cfg.redirect_uri)
-    host = ru.hostname or "127.0.0.1"
-    port = ru.port or 8765
-    path = ru.path or "/callback"
+    # Reuse the token of a previous run while it is still valid
+    token = _load_cached_token(cfg.client_id) if cfg.use_cache else None
+    if token:
+        print("Using cached OIDC token.")
+        rc = spacetime_login(token)
+        if rc is None:
+            return 4
+        if rc == 0:
+            print("Spacetime login succeeded via cached OIDC token.")
+            return 0
+        _drop_cached_token(cfg.client_id)
+        print("Cached token was rejected; starting a new login.", file=sys.stderr)
 
     # PKCE
     code_verifier, code_challenge = make_pkce_pair()
     state = b64url_no_pad(os.urandom(16))
 
     # Start local receiver
-    receiver = CodeReceiver(host, port, path, state)
+    receiver = CodeReceiver(REDIRECT_HOST, REDIRECT_PORT, REDIRECT_PATH, state)
     receiver.start()
 
     # Build auth URL
-    auth_params = {
-        "response_type": "code",
-        "client_id": cfg.client_id,
-        "redirect_uri": cfg.redirect_uri,
-        "scope": cfg.scope,
-        "code_challenge": code_challenge,
-        "code_challenge_method": "S256",
-        "state": state,
-    }
-    auth_url_full = cfg.auth_url
-    sep = "&" if ("?" in cfg.auth_url) else "?"
-    auth_url_full += sep + urllib.parse.urlencode(
-        auth_params,
-        quote_via=urllib.parse.quote,
+    # code_challenge and state are base64url and need no quoting
+    auth_url_full = (
+        f"{AUTH_URL}?{_AUTH_STATIC}"
+        f"&client_id={urllib.parse.quote(cfg.client_id, safe='')}"
+        f"&code_challenge={code_challenge}&state={state}"
     )
 
-    # Open browser
-    webbrowser.open(auth_url_full)
+    # Open browser without blocking: some launchers (e.g. a terminal browser
+    # set in $BROWSER) only return once the browser exits, and the callback
+    # is served on this thread.
+    import threading
+    import webbrowser
+
+    threading.Thread(target=webbrowser.open, args=(auth_url_full,), daemon=True).start()
     print(
-        "Opened browser for login. If it didn't open, visit:\n",
+        "Opening browser for login. If it doesn't open, visit:\n",
         f"{auth_url_full}",
         sep="",
     )
 
     # Wait for callback
-    code, recv_state = receiver.wait_for_code(timeout=cfg.timeout)
+    try:
+        code, recv_state = receiver.wait_for_code(timeout=cfg.timeout)
+    except KeyboardInterrupt:
+        print("Aborted.", file=sys.stderr)
+        return 130
+    if receiver.error:
+        msg = f"Authorization failed: {receiver.error}"
+        if receiver.error_description:
+            msg += f" ({receiver.error_description})"
+        print(msg, file=sys.stderr)
+        return 2
     if not code:
-        msg = f"No authorization code on {cfg.redirect_uri} (timeout)."
+        if receiver.timed_out:
+            msg = f"No authorization code on {REDIRECT_URI} (timeout)."
+        else:
+            msg = f"Callback on {REDIRECT_URI} carried no authorization code."
         print(msg, file=sys.stderr)
         return 2
     if recv_state != state:
@@ -239,55 +367,66 @@ def main() -> int:
         "grant_type": "authorization_code",
         "client_id": cfg.client_id,
         "code": code,
-        "redirect_uri": cfg.redirect_uri,
+        "redirect_uri": REDIRECT_URI,
         "code_verifier": code_verifier,
     }
     data = urllib.parse.urlencode(token_params).encode()
+    import http.client
+
+    conn = http.client.HTTPConnection(TOKEN_HOST, TOKEN_PORT, timeout=30)
     try:
-        req = urllib.request.Request(
-            cfg.token_url,
-            data=data,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        conn.request(
+            "POST",
+            TOKEN_PATH,
+            body=data,
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+                "Content-Length": str(len(data)),
+            },
         )
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            body = resp.read().decode()
+        resp = conn.getresponse()
+        body = resp.read().decode()
     except Exception as e:
         print(f"Token request failed: {e}", file=sys.stderr)
         return 3
+    finally:
+        conn.close()
+    if resp.status != 200:
+        print(f"Token request failed: HTTP {resp.status} {resp.reason}", file=sys.stderr)
+        print(body, file=sys.stderr)
+        return 3
 
     try:
-        tok = json.loads(body)
+        tok = _token_fields(body)
     except Exception:
         print("Failed to parse token response:", file=sys.stderr)
         print(body, file=sys.stderr)
         return 3
 
-    token = tok.get("id_token") or tok.get("access_token")
+    id_token = tok.get("id_token")
+    token = id_token or tok.get("access_token")
     if not token:
         print("No usable token in response:", file=sys.stderr)
         print(json.dumps(tok, indent=2), file=sys.stderr)
         return 3
 
     # Login to Spacetime
-    try:
-        r = subprocess.run(
-            ["spacetime", "login", "--token", token],
-            check=False,
+    rc = spacetime_login(token)
+    if rc is None:
+        return 4
+    if rc != 0:
+        print(
+            "Spacetime login with provided token failed. "
+            "You may need a Spacetime-issued token or configure "
+            "--server-issued-login instead.",
+            file=sys.stderr,
         )
-        if r.returncode == 0:
-            print("Spacetime login succeeded via OIDC token.")
-            return 0
-        else:
-            print(
-                "Spacetime login with provided token failed. "
-                "You may need a Spacetime-issued token or configure "
-                "--server-issued-login instead.",
-                file=sys.stderr,
-            )
-            return 4
-    except FileNotFoundError:
-        print("'spacetime' CLI not found in PATH.", file=sys.stderr)
         return 4
+    # Only an id_token the CLI accepted is worth reusing
+    if cfg.use_cache and id_token:
+        _store_token(cfg.client_id, id_token)
+    print("Spacetime login succeeded via OIDC token.")
+    return 0
 
 
 if __name__ == "__main__":